@@ -0,0 +1,92 @@
+import math
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import cancellation
+import metrics
+
+# name, how many calls of this class may use the model at once, how many may wait for it
+PriorityClass = namedtuple("PriorityClass", ["name", "concurrency", "max_queue"])
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing when a priority class already has a full queue."""
+
+    def __init__(self, priority, retry_after):
+        super().__init__("{} queue is full, retry in {}s".format(priority, retry_after))
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+# summary: AdmissionController schedules model calls by priority class. At most `slots`
+#          calls run at once and each class has its own concurrency limit. A class only
+#          starts work when no higher class has waiters that could start, so heavy work
+#          queues behind interactive work. Full queues reject immediately with a retry hint.
+# parameters: slots, total number of concurrent model calls
+#             classes, list of PriorityClass, highest priority first
+#######################################################################################
+class AdmissionController:
+    def __init__(self, slots, classes):
+        self.slots = slots
+        self.classes = {c.name: c for c in classes}
+        self.order = [c.name for c in classes]
+        self.running = {name: 0 for name in self.order}
+        self.waiting = {name: 0 for name in self.order}
+        # moving average of how long a call of each class holds the model, in seconds
+        self.service_time = {name: 1.0 for name in self.order}
+        self.cond = threading.Condition()
+
+    def can_run(self, name):
+        if sum(self.running.values()) >= self.slots:
+            return False
+        if self.running[name] >= self.classes[name].concurrency:
+            return False
+        for higher in self.order[: self.order.index(name)]:
+            if (
+                self.waiting[higher]
+                and self.running[higher] < self.classes[higher].concurrency
+            ):
+                return False
+        return True
+
+    def retry_after(self, name):
+        """Rough number of seconds until the queue of this class has drained."""
+        backlog = self.waiting[name] + self.running[name]
+        concurrency = max(self.classes[name].concurrency, 1)
+        return max(1, math.ceil(backlog * self.service_time[name] / concurrency))
+
+    @contextmanager
+    def admit(self, name):
+        with self.cond:
+            if self.waiting[name] >= self.classes[name].max_queue and not self.can_run(
+                name
+            ):
+                metrics.ADMISSION_REJECTED.labels(name).inc()
+                raise Overloaded(name, self.retry_after(name))
+            self.waiting[name] += 1
+            metrics.ADMISSION_QUEUE.labels(name).inc()
+            admitted = False
+            try:
+                while not self.can_run(name):
+                    # wake up regularly so deadlines and superseding apply while queued
+                    self.cond.wait(0.1)
+                    cancellation.check()
+                admitted = True
+            finally:
+                self.waiting[name] -= 1
+                metrics.ADMISSION_QUEUE.labels(name).dec()
+                if not admitted:
+                    self.cond.notify_all()
+            self.running[name] += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running[name] -= 1
+                elapsed = time.monotonic() - start
+                self.service_time[name] = 0.8 * self.service_time[name] + 0.2 * elapsed
+                self.cond.notify_all()
@@ -1,8 +1,14 @@
 # pylint: disable=E1101
-from flask import Flask, render_template, request, url_for, jsonify
+from flask import Flask, render_template, request, url_for, jsonify, g
 from flask_cors import CORS
+import logging
+import os
 import random
 import string
+import time
+import admission
+import cancellation
+import metrics
 import models
 import json
 
@@ -14,6 +20,74 @@ app.config.from_object(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 
+@app.before_request
+def start_trace():
+    g.request_id = request.headers.get("X-Request-Id") or metrics.new_request_id()
+    g.request_token = metrics.request_id.set(g.request_id)
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def end_trace(response):
+    if request.endpoint and request.endpoint != "metrics_endpoint":
+        metrics.REQUEST_LATENCY.labels(request.endpoint).observe(
+            time.perf_counter() - g.start_time
+        )
+    response.headers["X-Request-Id"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def reset_trace(exc):
+    if "request_token" in g:
+        metrics.request_id.reset(g.request_token)
+
+
+class InvalidRequest(Exception):
+    """A malformed request field, answered with 400."""
+
+
+@app.errorhandler(InvalidRequest)
+def invalid_request(err):
+    return jsonify({"error": str(err)}), 400
+
+
+@app.errorhandler(cancellation.Cancelled)
+def cancelled(err):
+    metrics.CANCELLED.labels(request.endpoint, err.reason).inc()
+    # 409 when a newer request from the same session replaced this one
+    status = 409 if err.reason == "superseded" else 504
+    return jsonify({"error": "cancelled", "reason": err.reason}), status
+
+
+@app.errorhandler(admission.Overloaded)
+def overloaded(err):
+    response = jsonify(
+        {"error": "overloaded", "priority": err.priority, "retryAfter": err.retry_after}
+    )
+    response.headers["Retry-After"] = str(err.retry_after)
+    return response, 503
+
+
+# every route accepts optional "session" and "deadlineMs" fields: a newer request of the
+# same kind from the same session cancels the older one, and work stops once the deadline
+# (milliseconds from receipt) passes. Malformed values are rejected with 400.
+def request_scope(data):
+    session = data.get("session")
+    deadline_ms = data.get("deadlineMs")
+    try:
+        cancellation.validate(session, deadline_ms)
+    except ValueError as err:
+        raise InvalidRequest(err)
+    return cancellation.scope(session, deadline_ms, request.endpoint)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body, content_type = metrics.exposition()
+    return body, 200, {"Content-Type": content_type}
+
+
 @app.route("/api/result", methods=["GET"])
 def result():
     content = request.args.get("q")
@@ -21,8 +95,20 @@ def result():
 
     english = data["english"]
 
-    result = models.generate_alternatives(english)
-    print(result)
+    # optional list of mbart-50 pivot languages, e.g. ["nl_XX", "de_DE", "fr_XX"]
+    pivots = data.get("pivots")
+    # optional cap on how many candidate prefixes get decoded
+    max_prefixes = data.get("maxPrefixes")
+    try:
+        models.validate_pivots(pivots)
+        models.validate_max_prefixes(max_prefixes)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+
+    with request_scope(data):
+        result = models.generate_alternatives(
+            english, pivots=pivots, max_prefixes=max_prefixes
+        )
     return jsonify(result)
 
 
@@ -35,7 +121,9 @@ def incremental():
     prefix = data["prefix"]
     recalculation = data["recalculation"]
 
-    return jsonify(models.incremental_alternatives(english, prefix, recalculation))
+    with request_scope(data):
+        result = models.incremental_alternatives(english, prefix, recalculation)
+    return jsonify(result)
 
 
 @app.route("/api/completion", methods=["GET"])
@@ -46,7 +134,14 @@ def completion():
     sentence = data["sentence"]
     prefix = data["prefix"]
 
-    return jsonify(models.completion(sentence, prefix))
+    # optionally prefetch completions for the likely next words (needs a session)
+    speculate = data.get("speculate", False)
+
+    with request_scope(data):
+        result = models.completion(
+            sentence, prefix, session=data.get("session"), speculate=speculate
+        )
+    return jsonify(result)
 
 
 @app.route("/api/constraints", methods=["GET"])
@@ -57,9 +152,33 @@ def constraints():
     sentence = data["sentence"]
     constraints = data["constraints"]
 
-    return jsonify(models.generate_constraints(sentence, constraints))
+    with request_scope(data):
+        result = models.generate_constraints(sentence, constraints)
+    return jsonify(result)
+
+
+@app.route("/api/batch", methods=["POST"])
+def batch():
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("operations"), list):
+        return jsonify({"error": "expected a JSON body with an operations list"}), 400
+    if len(data["operations"]) > models.max_batch_operations:
+        message = "at most {} operations per batch".format(models.max_batch_operations)
+        return jsonify({"error": message}), 400
+
+    with request_scope(data):
+        results = models.run_batch(data["operations"])
+    return jsonify({"results": results})
 
 
 if __name__ == "__main__":
+    # LOG_LEVEL=DEBUG turns on per-stage span logging
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        metrics.SpanFormatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+    )
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "INFO").upper(), handlers=[handler]
+    )
     # disable reloader as it causes issues with gpu memory
     app.run(debug=True, use_reloader=False, port=5009)
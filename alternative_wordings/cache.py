@@ -0,0 +1,37 @@
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache that counts its hits and misses in /metrics."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            hit = key in self.data
+            if hit:
+                self.data.move_to_end(key)
+                value = self.data[key]
+        metrics.record_cache(self.name, hit)
+        return value if hit else default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        return len(self.data)
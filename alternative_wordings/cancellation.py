@@ -0,0 +1,97 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Cancelled(Exception):
+    """Raised inside a model call whose request was superseded or ran past its deadline."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    def __init__(self, deadline=None):
+        # deadline is a time.monotonic() value, or None for no deadline
+        self.deadline = deadline
+        self.superseded = False
+
+    def cancel(self):
+        self.superseded = True
+
+    def check(self):
+        if self.superseded:
+            raise Cancelled("superseded")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise Cancelled("deadline")
+
+
+# token of the request running in the current thread, if any
+current = contextvars.ContextVar("cancel_token", default=None)
+
+# (session, kind) -> token of the newest request for it
+_active = {}
+_lock = threading.Lock()
+
+
+def validate(session, deadline_ms):
+    """Raise ValueError for a non-string session or a deadline_ms that is not positive."""
+    if session is not None and not isinstance(session, str):
+        raise ValueError("session must be a string")
+    if deadline_ms is None:
+        return
+    if (
+        not isinstance(deadline_ms, (int, float))
+        or isinstance(deadline_ms, bool)
+        or not deadline_ms > 0
+    ):
+        raise ValueError("deadlineMs must be a positive number")
+
+
+# summary: scope makes a cancel token current for the code run inside it. Starting a scope
+#          for a session cancels the token of the previous, still running, scope with the
+#          same session and kind.
+# parameters: session, client or session id, or None to never supersede
+#             deadline_ms, milliseconds from now after which the work is abandoned, or None
+#             kind, separates independent request types from the same session
+#######################################################################################
+@contextmanager
+def scope(session=None, deadline_ms=None, kind=""):
+    deadline = None
+    if deadline_ms is not None:
+        deadline = time.monotonic() + float(deadline_ms) / 1000
+    token = CancelToken(deadline)
+    key = None if session is None else (session, kind)
+    if key is not None:
+        with _lock:
+            previous = _active.get(key)
+            if previous is not None:
+                previous.cancel()
+            _active[key] = token
+
+    reset = current.set(token)
+    try:
+        yield token
+    finally:
+        current.reset(reset)
+        if key is not None:
+            with _lock:
+                if _active.get(key) is token:
+                    del _active[key]
+
+
+def cancel(session, kind=""):
+    """Cancel the running scope for session and kind, if there is one."""
+    with _lock:
+        token = _active.get((session, kind))
+    if token is not None:
+        token.cancel()
+
+
+def check():
+    """Raise Cancelled if the current request was superseded or is past its deadline."""
+    token = current.get()
+    if token is not None:
+        token.check()
@@ -0,0 +1,39 @@
+"""One-time conversion of the model checkpoints to formats that load by memory-mapping.
+
+mbart50.ft.nn/model.pt is rewritten without its optimizer state as
+mbart50.ft.nn/model.mmap.pt, and the Marian models are saved as safetensors under
+marian_safetensors/. mbartAlt and marianAlt use the converted files when they exist.
+
+    python convert_checkpoints.py            # both
+    python convert_checkpoints.py mbart      # only mBART-50
+"""
+
+import argparse
+
+import marian_model
+import mbart_model
+
+MARIAN_MODELS = ["Helsinki-NLP/opus-mt-en-ROMANCE", "Helsinki-NLP/opus-mt-ROMANCE-en"]
+
+
+def convert_mbart():
+    bart = mbart_model.load_pretrained("nl_XX")
+    mbart_model.save_mapped(bart)
+    print("wrote", mbart_model.MAPPED_CHECKPOINT)
+
+
+def convert_marian():
+    for name in MARIAN_MODELS:
+        print("wrote", marian_model.save_mapped(name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "models", nargs="*", choices=["mbart", "marian"], default=["mbart", "marian"]
+    )
+    args = parser.parse_args()
+    if "mbart" in args.models:
+        convert_mbart()
+    if "marian" in args.models:
+        convert_marian()
@@ -1,9 +1,35 @@
+import logging
+import os
 import torch
 from transformers import MarianMTModel, MarianTokenizer
+import cancellation
+from metrics import record_generation
+
+logger = logging.getLogger(__name__)
+
+
+# written by convert_checkpoints.py, one subdirectory per model
+MAPPED_DIR = "marian_safetensors"
+
+
+def model_path(name):
+    """Local safetensors copy of a Hugging Face model if converted, else its hub name."""
+    path = os.path.join(MAPPED_DIR, name.replace("/", "--"))
+    return path if os.path.isdir(path) else name
+
+
+def save_mapped(name):
+    """Save a model and its tokenizer as safetensors, which load by memory-mapping."""
+    path = os.path.join(MAPPED_DIR, name.replace("/", "--"))
+    MarianTokenizer.from_pretrained(name).save_pretrained(path)
+    MarianMTModel.from_pretrained(name).save_pretrained(path, safe_serialization=True)
+    return path
 
 
 class CustomMTModel(MarianMTModel):
     def adjust_logits_during_generation(self, logits, cur_len, max_length):
+        # called once per generate step, so superseded requests stop here
+        cancellation.check()
         if not self.original_postprocess:
             if 0 < cur_len <= len(self.selected_tokens):
                 force_token_id = self.selected_tokens[cur_len - 1]
@@ -16,28 +42,77 @@ class CustomMTModel(MarianMTModel):
         )
 
 
+class PrefixTrie:
+    """Token trie of forced prefixes, phrases with the same leading tokens share a path."""
+
+    def __init__(self):
+        self.children = {}
+        self.phrases = []
+
+    def insert(self, tokens, phrase):
+        node = self
+        for token in tokens:
+            node = node.children.setdefault(token, PrefixTrie())
+        node.phrases.append(phrase)
+
+
+def banned_ngram_tokens(tokens, n):
+    """Tokens that would repeat an n-gram already in tokens (as no_repeat_ngram_size)."""
+    if len(tokens) + 1 < n:
+        return []
+    tail = tuple(tokens[len(tokens) - n + 1 :])
+    return [
+        tokens[i + n - 1]
+        for i in range(len(tokens) - n + 1)
+        if tuple(tokens[i : i + n - 1]) == tail
+    ]
+
+
 class marianAlt:
+    # low_cpu_mem_usage (needs accelerate) builds the models empty and loads the weights
+    # from the files directly, so converted safetensors copies are mapped rather than
+    # copied into a randomly initialised model
     def __init__(self, lang: str):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        en_ROMANCE_model_name = "Helsinki-NLP/opus-mt-en-ROMANCE"
+        en_ROMANCE_model_name = model_path("Helsinki-NLP/opus-mt-en-ROMANCE")
         self.en_ROMANCE_tokenizer = MarianTokenizer.from_pretrained(
             en_ROMANCE_model_name
         )
-        self.en_ROMANCE = MarianMTModel.from_pretrained(en_ROMANCE_model_name).to(
-            self.device
-        )
+        self.en_ROMANCE = MarianMTModel.from_pretrained(
+            en_ROMANCE_model_name, low_cpu_mem_usage=True
+        ).to(self.device)
 
-        ROMANCE_en_model_name = "Helsinki-NLP/opus-mt-ROMANCE-en"
+        ROMANCE_en_model_name = model_path("Helsinki-NLP/opus-mt-ROMANCE-en")
         self.ROMANCE_en_tokenizer = MarianTokenizer.from_pretrained(
             ROMANCE_en_model_name
         )
-        self.ROMANCE_en = MarianMTModel.from_pretrained(ROMANCE_en_model_name).to(
-            self.device
-        )
+        self.ROMANCE_en = MarianMTModel.from_pretrained(
+            ROMANCE_en_model_name, low_cpu_mem_usage=True
+        ).to(self.device)
         self.ROMANCE_en.__class__ = CustomMTModel
 
         self.lang = lang
 
+    # summary: pivot_translations translates english sentences into the pivot language in one batch
+    # parameters: sentences, list of english sentences
+    # returns: list of machine translations, in the same order as sentences
+    def pivot_translations(self, sentences: [str]):
+        self.ROMANCE_en.original_postprocess = True
+        # Specifies target language to translate
+        english = [self.lang + sentence for sentence in sentences]
+        eng_to_spanish = self.en_ROMANCE.generate(
+            **self.en_ROMANCE_tokenizer(english, return_tensors="pt", padding=True).to(
+                self.device
+            )
+        ).to(self.device)
+        # shorter rows in the batch are right-padded, so drop the trailing pads too
+        return [
+            self.en_ROMANCE_tokenizer.decode(row)
+            .replace("<pad> ", "")
+            .replace("<pad>", "")
+            for row in eng_to_spanish
+        ]
+
     def translate(self, text, num_outputs):
         """Use beam search to get a reasonable translation of 'text'"""
         # Tokenize the source text
@@ -56,6 +131,11 @@ class marianAlt:
             max_length=40,
             no_repeat_ngram_size=5
         )
+        record_generation(
+            "marian",
+            num_beams,
+            (translated != self.ROMANCE_en.config.pad_token_id).sum().item(),
+        )
 
         # Untokenize the output text.
         self.ROMANCE_en_tokenizer.current_spm = self.ROMANCE_en_tokenizer.spm_target
@@ -104,6 +184,7 @@ class marianAlt:
 
         # generate tokens incrementally
         while True:
+            cancellation.check()
             model_inputs = model.prepare_inputs_for_generation(
                 partial_decode,
                 past=past,
@@ -135,17 +216,8 @@ class marianAlt:
             token_score = next_token_logprobs[0][next_token_to_add].item()
             total += token_score
 
-            # append top 10 predictions for each token to list
-            decoded_predictions = []
-            for tok in next_token_logits[0].topk(10).indices:
-                decoded_predictions.append(
-                    tokenizer.convert_ids_to_tokens(tok.item()).replace(
-                        "\u2581", "\u00a0"
-                    )
-                )
-
-            # list of lists of predictions
-            prediction_list.append(decoded_predictions)
+            # list of lists of top 10 predictions for each token
+            prediction_list.append(self.top_predictions(next_token_logits))
 
             # add new token to tokens so far
             partial_decode = torch.cat(
@@ -157,6 +229,8 @@ class marianAlt:
             if not (num_tokens_generated < MAX_LENGTH):
                 break
 
+        record_generation("marian.incremental", 1, num_tokens_generated)
+
         # list of tokens used to display sentence
         decoded_tokens = [
             sub.replace("\u2581", "\u00a0")
@@ -165,7 +239,7 @@ class marianAlt:
         decoded_tokens.remove("<pad>")
 
         final = tokenizer.decode(partial_decode[0]).replace("<pad>", "")
-        score = round(total / (len(decoded_tokens)), 3)
+        score = round(total / max(len(decoded_tokens), 1), 3)
 
         return {
             "final": final.lstrip(),
@@ -175,6 +249,55 @@ class marianAlt:
             "score": score,
         }
 
+    def top_predictions(self, next_token_logits, k=10):
+        return [
+            self.ROMANCE_en_tokenizer.convert_ids_to_tokens(tok.item()).replace(
+                "\u2581", "\u00a0"
+            )
+            for tok in next_token_logits[0].topk(k).indices
+        ]
+
+    # summary: next_words predicts the most likely ways to extend a prefix by one token
+    # parameters: machine_translation, the spanish translation
+    #             prefix, the english typed so far
+    #             k, number of extended prefixes to return
+    # returns: list of up to k prefixes, each prefix followed by one predicted token, most likely first
+    def next_words(self, machine_translation, prefix, k):
+        predictions = self.top_predictions(
+            self.prefix_logits(machine_translation, prefix)
+        )
+        candidates = []
+        for token in predictions:
+            if token in self.ROMANCE_en_tokenizer.all_special_tokens:
+                continue
+            if token.startswith("\u00a0"):
+                # a new word
+                candidates.append((prefix + " " + token[1:]).lstrip())
+            else:
+                # continues the last word
+                candidates.append(prefix + token)
+        return candidates[:k]
+
+    def prefix_logits(self, machine_translation, prefix):
+        """Next token logits after prefix, from one decoder pass over the forced tokens."""
+        tokenizer = self.ROMANCE_en_tokenizer
+        model = self.ROMANCE_en
+        # encode the source and force the prefix the same way completion() does
+        tokenizer.current_spm = tokenizer.spm_source  # HACK! as in translate()
+        batch = tokenizer(
+            ">>en<<" + machine_translation, return_tensors="pt", padding=True
+        ).to(self.device)
+        tokenizer.current_spm = tokenizer.spm_target
+        tokens = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(prefix))
+        decoded = torch.LongTensor([[model.config.decoder_start_token_id] + tokens])
+        cancellation.check()
+        with torch.no_grad():
+            encoder_outputs = model.get_encoder()(**batch)
+            logits, _ = self.decoder_step(
+                decoded.to(self.device), None, encoder_outputs, batch["attention_mask"]
+            )
+        return logits
+
     # summary: incremental_alternatives is mainly used to generate the translation of the original sentence
     #          before feeding it to incremental_generation()
     # parameters: sentence, the sentence to generate alternatives of
@@ -188,48 +311,21 @@ class marianAlt:
     #               score for average predictability
     #######################################################################################
     def incremental_alternatives(self, sentence, prefix, recalculation):
-        self.ROMANCE_en.original_postprocess = True
-        english = self.lang + sentence
-        eng_to_spanish = self.en_ROMANCE.generate(
-            **self.en_ROMANCE_tokenizer(english, return_tensors="pt", padding=True).to(
-                self.device
-            )
-        ).to(self.device)
-        machine_translation = self.en_ROMANCE_tokenizer.decode(
-            eng_to_spanish[0]
-        ).replace("<pad> ", "")
+        machine_translation = self.pivot_translations([sentence])[0]
         if recalculation:
             sentence = prefix
         return self.incremental_generation(machine_translation, sentence, False)
 
     def get_prefix_alts(self, sentence, phrases: [str]):
-        # prepare input for translation
-        self.ROMANCE_en.original_postprocess = True
-        # Specifies target language to translate
-        english = self.lang + sentence
-        eng_to_spanish = self.en_ROMANCE.generate(
-            **self.en_ROMANCE_tokenizer(english, return_tensors="pt", padding=True).to(
-                self.device
-            )
-        ).to(self.device)
-        machine_translation = self.en_ROMANCE_tokenizer.decode(
-            eng_to_spanish[0]
-        ).replace("<pad> ", "")
+        machine_translation = self.pivot_translations([sentence])[0]
+
+        top50s = self.prefix_translations(machine_translation, phrases, 50)
 
         results = []
         # generate alternatives starting with each selected phrase
-        for selection in set(phrases):
+        for selection in dict.fromkeys(phrases):
             resultset = []
-            self.ROMANCE_en_tokenizer.current_spm = self.ROMANCE_en_tokenizer.spm_target
-            tokens = self.ROMANCE_en_tokenizer.tokenize(selection)
-            self.ROMANCE_en.selected_tokens = (
-                self.ROMANCE_en_tokenizer.convert_tokens_to_ids(tokens)
-            )
-
-            self.ROMANCE_en.original_postprocess = False
-            print(self.ROMANCE_en.__class__)
-            top50 = self.translate(">>en<<" + machine_translation, 50)
-            for element in top50[0:3]:
+            for element in top50s[selection][0:3]:
                 res = self.incremental_generation(
                     machine_translation, element, prefix_only=False
                 )
@@ -237,25 +333,207 @@ class marianAlt:
             results.append(resultset)
         return results
 
+    # summary: prefix_translations gives the same beam search results as forcing each
+    #          phrase with translate(), but decodes the forced prefixes as a token trie so
+    #          decoder steps for leading tokens shared by several phrases run only once
+    # parameters: machine_translation, the pivot language translation
+    #             phrases, prefixes to force at the start of the english
+    #             num_outputs, beam size and number of translations to return per phrase
+    # returns: dict of phrase -> list of translations, best first
+    #######################################################################################
+    def prefix_translations(self, machine_translation, phrases: [str], num_outputs):
+        tokenizer = self.ROMANCE_en_tokenizer
+        model = self.ROMANCE_en
+        model.original_postprocess = True
+
+        tokenizer.current_spm = tokenizer.spm_source  # HACK! as in translate()
+        batch = tokenizer(
+            ">>en<<" + machine_translation, return_tensors="pt", padding=True
+        ).to(self.device)
+        tokenizer.current_spm = tokenizer.spm_target
+        trie = PrefixTrie()
+        for phrase in dict.fromkeys(phrases):
+            trie.insert(
+                tokenizer.convert_tokens_to_ids(tokenizer.tokenize(phrase)), phrase
+            )
+
+        translations = {}
+        steps = 0
+        with torch.no_grad():
+            encoder_outputs = model.get_encoder()(**batch)
+            start = torch.LongTensor([[model.config.decoder_start_token_id]])
+            # each entry holds the decoded tokens and the cache for all but the last one
+            stack = [(trie, start.to(self.device), None)]
+            while stack:
+                cancellation.check()
+                node, decoded, past = stack.pop()
+                logits, past = self.decoder_step(
+                    decoded, past, encoder_outputs, batch["attention_mask"]
+                )
+                steps += 1
+                if node.phrases:
+                    logger.debug("forcing prefixes %r", node.phrases)
+                    hypotheses = self.beam_search(
+                        decoded,
+                        past,
+                        logits,
+                        encoder_outputs,
+                        batch["attention_mask"],
+                        num_outputs,
+                    )
+                    decoded_hypotheses = [
+                        tokenizer.decode(
+                            t,
+                            skip_special_tokens=True,
+                            clean_up_tokenization_spaces=False,
+                        )
+                        for t in hypotheses
+                    ]
+                    for phrase in node.phrases:
+                        translations[phrase] = decoded_hypotheses
+                # branches get their own copy of the cache as decoding may update it in place
+                copy_idx = torch.zeros(1, dtype=torch.long, device=self.device)
+                for i, (token, child) in enumerate(node.children.items()):
+                    next_token = torch.LongTensor([[token]]).to(self.device)
+                    branch_past = (
+                        past if i == 0 else model._reorder_cache(past, copy_idx)
+                    )
+                    stack.append(
+                        (child, torch.cat((decoded, next_token), -1), branch_past)
+                    )
+        logger.debug("decoded %d prefixes in %d shared steps", len(translations), steps)
+        return translations
+
+    def decoder_step(self, decoded, past, encoder_outputs, attention_mask):
+        """Run the decoder on the last token of decoded, returning its logits and cache."""
+        model = self.ROMANCE_en
+        model_inputs = model.prepare_inputs_for_generation(
+            decoded,
+            past=past,
+            encoder_outputs=encoder_outputs,
+            attention_mask=attention_mask,
+            use_cache=True,
+        )
+        model_outputs = model(**model_inputs)
+        return model_outputs[0][:, -1, :], model_outputs[1]
+
+    # summary: beam_search continues a forced prefix with the same search translate() runs
+    #          (generate's beam search with max_length=40 and no_repeat_ngram_size=5).
+    #          Forced tokens score 0 there, so the prefix adds nothing to the scores here.
+    # parameters: decoded, 1 x len tensor of the forced tokens, starting with the decoder start token
+    #             past, decoder cache for decoded
+    #             logits, next token logits after decoded
+    #             encoder_outputs, attention_mask, encoder results for the source (batch of 1)
+    #             num_beams, beam size and number of sequences to return
+    # returns: list of token id lists, best first
+    #######################################################################################
+    def beam_search(
+        self,
+        decoded,
+        past,
+        logits,
+        encoder_outputs,
+        attention_mask,
+        num_beams,
+        max_length=40,
+        no_repeat_ngram_size=5,
+    ):
+        model = self.ROMANCE_en
+        eos = model.config.eos_token_id
+        length_penalty = model.config.length_penalty
+        cur_len = decoded.shape[1]
+
+        # expand everything to num_beams rows with only the first beam alive
+        beam_idx = torch.zeros(num_beams, dtype=torch.long, device=self.device)
+        encoder_outputs = (encoder_outputs[0].index_select(0, beam_idx),)
+        attention_mask = attention_mask.index_select(0, beam_idx)
+        past = model._reorder_cache(past, beam_idx)
+        logits = logits.index_select(0, beam_idx)
+        beams = [decoded[0].tolist() for _ in range(num_beams)]
+        beam_scores = torch.zeros(num_beams, device=self.device)
+        beam_scores[1:] = -1e9
+        finished = []  # (normalized score, tokens)
+
+        def add_finished(tokens, sum_logprobs):
+            finished.append((sum_logprobs / len(tokens) ** length_penalty, tokens))
+            finished.sort(key=lambda x: x[0], reverse=True)
+            del finished[num_beams:]
+
+        done = False
+        while cur_len < max_length:
+            cancellation.check()
+            logits = model.adjust_logits_during_generation(
+                logits, cur_len=cur_len, max_length=max_length
+            )
+            scores = torch.log_softmax(logits, dim=-1)
+            if cur_len < model.config.min_length:
+                scores[:, eos] = -float("inf")
+            # one indexed assignment instead of a tensor write per banned token
+            banned = [
+                (i, token)
+                for i, tokens in enumerate(beams)
+                for token in banned_ngram_tokens(tokens, no_repeat_ngram_size)
+            ]
+            if banned:
+                rows, columns = zip(*banned)
+                scores[list(rows), list(columns)] = -float("inf")
+
+            vocab_size = scores.shape[-1]
+            next_scores = (scores + beam_scores[:, None]).view(-1)
+            next_scores, next_ids = torch.topk(next_scores, 2 * num_beams)
+
+            next_beams = []
+            for rank, (score, idx) in enumerate(
+                zip(next_scores.tolist(), next_ids.tolist())
+            ):
+                beam_id, token = divmod(idx, vocab_size)
+                if token == eos:
+                    if rank < num_beams:
+                        add_finished(beams[beam_id], score)
+                else:
+                    next_beams.append((score, token, beam_id))
+                if len(next_beams) == num_beams:
+                    break
+
+            if len(finished) == num_beams:
+                best = next_scores.max().item() / cur_len**length_penalty
+                done = finished[-1][0] >= best
+            if done:
+                break
+
+            beam_idx = torch.tensor([b for _, _, b in next_beams], device=self.device)
+            beams = [beams[b] + [token] for _, token, b in next_beams]
+            beam_scores = torch.tensor(
+                [s for s, _, _ in next_beams], device=self.device
+            )
+            past = model._reorder_cache(past, beam_idx)
+            cur_len += 1
+            if cur_len < max_length:
+                next_tokens = torch.tensor(beams, device=self.device)
+                logits, past = self.decoder_step(
+                    next_tokens, past, encoder_outputs, attention_mask
+                )
+
+        if not done:
+            for tokens, score in zip(beams, beam_scores.tolist()):
+                add_finished(tokens, score)
+        record_generation(
+            "marian", num_beams, sum(len(tokens) for _, tokens in finished)
+        )
+        return [tokens for _, tokens in finished]
+
     # summary: completion
     # parameters: sentence, the sentence to generate alternatives of
     #             prefix, A prefix to force in generating new sentence
+    #             machine_translation, optional precomputed pivot_translations() output for sentence
     # returns: dict including:
     #               endings, list possible alternative sentence endings
     #               differences, a list for each alternative sentence specifying the differences
     #                   between it and the original
     #######################################################################################
-    def completion(self, sentence, prefix):
-        self.ROMANCE_en.original_postprocess = True
-        english = self.lang + sentence
-        eng_to_spanish = self.en_ROMANCE.generate(
-            **self.en_ROMANCE_tokenizer(english, return_tensors="pt", padding=True).to(
-                self.device
-            )
-        ).to(self.device)
-        machine_translation = self.en_ROMANCE_tokenizer.decode(
-            eng_to_spanish[0]
-        ).replace("<pad> ", "")
+    def completion(self, sentence, prefix, machine_translation=None):
+        if machine_translation is None:
+            machine_translation = self.pivot_translations([sentence])[0]
 
         self.ROMANCE_en_tokenizer.current_spm = self.ROMANCE_en_tokenizer.spm_target
         tokens = self.ROMANCE_en_tokenizer.tokenize(prefix)
@@ -271,17 +549,35 @@ class marianAlt:
 
 if __name__ == "__main__":
     marian = marianAlt(">>es<<")
-    print(
-        marian.get_prefix_alts(
-            "She shot the cow during a time of scarcity to feed her hungry family.",
-            [
-                "During a time of scarcity",
-                "Of scarcity",
-                "She ",
-                "The cow",
-                "Her hungry family",
-                "To feed her hungry family",
-                "She shot",
-            ],
+    sentence = "She shot the cow during a time of scarcity to feed her hungry family."
+    phrases = [
+        "During a time of scarcity",
+        "Of scarcity",
+        "She ",
+        "The cow",
+        "Her hungry family",
+        "To feed her hungry family",
+        "She shot",
+    ]
+
+    # check that the shared trie decoding matches forcing each phrase through generate
+    machine_translation = marian.pivot_translations([sentence])[0]
+    shared = marian.prefix_translations(machine_translation, phrases, 50)
+    for phrase in phrases:
+        marian.ROMANCE_en_tokenizer.current_spm = marian.ROMANCE_en_tokenizer.spm_target
+        marian.ROMANCE_en.selected_tokens = (
+            marian.ROMANCE_en_tokenizer.convert_tokens_to_ids(
+                marian.ROMANCE_en_tokenizer.tokenize(phrase)
+            )
         )
-    )
+        marian.ROMANCE_en.original_postprocess = False
+        independent = marian.translate(">>en<<" + machine_translation, 50)
+        marian.ROMANCE_en.original_postprocess = True
+        top = min(len(independent), len(shared[phrase]), 3)
+        status = "ok" if independent[:top] == shared[phrase][:top] else "MISMATCH"
+        print(status, repr(phrase))
+        if status != "ok":
+            print("  generate:", independent[:top])
+            print("  trie:    ", shared[phrase][:top])
+
+    print(marian.get_prefix_alts(sentence, phrases))
@@ -1,40 +1,173 @@
+import copy
+import logging
+import os
 import torch
+from fairseq import tasks, utils
+from fairseq.data import LanguagePairDataset, ListDataset
+from fairseq.hub_utils import GeneratorHubInterface
 from fairseq.token_generation_constraints import pack_constraints
 from fairseq.models.transformer import TransformerModel
+from omegaconf import OmegaConf, open_dict
 import re
+import cancellation
+from cache import LRUCache
+from metrics import record_generation
+
+logger = logging.getLogger(__name__)
 
 word_alts = False
 
+# written by convert_checkpoints.py, used instead of model.pt when present
+MAPPED_CHECKPOINT = "mbart50.ft.nn/model.mmap.pt"
 
-class mbartAlt:
-    def __init__(self, lang: str):
-        self.bart = TransformerModel.from_pretrained(
-            "mbart50.ft.nn",
-            checkpoint_file="model.pt",
-            data_name_or_path="mbart50.ft.nn",
-            bpe="sentencepiece",
-            sentencepiece_model="mbart50.ft.nn/sentence.bpe.model",
-            lang_dict="mbart50.ft.nn/ML50_langs.txt",
-            target_lang=lang,
-            source_lang="en_XX",
-            encoder_langtok="src",
+
+def load_pretrained(lang):
+    return TransformerModel.from_pretrained(
+        "mbart50.ft.nn",
+        checkpoint_file="model.pt",
+        data_name_or_path="mbart50.ft.nn",
+        bpe="sentencepiece",
+        sentencepiece_model="mbart50.ft.nn/sentence.bpe.model",
+        lang_dict="mbart50.ft.nn/ML50_langs.txt",
+        target_lang=lang,
+        source_lang="en_XX",
+        encoder_langtok="src",
+    )
+
+
+def save_mapped(bart, path=MAPPED_CHECKPOINT):
+    """Save the config and weights of a loaded model in a form load_mapped can map."""
+    # torch.save's zip format stores each tensor contiguously, so it can be mmapped;
+    # the original checkpoint is a pickle that also carries the optimizer state
+    torch.save({"cfg": bart.cfg, "model": bart.models[0].state_dict()}, path)
+
+
+# summary: load_mapped builds the hub interface from a save_mapped() checkpoint without
+#          reading the weights into memory: the model is built on the meta device and its
+#          parameters are then pointed at the memory-mapped tensors. Processes on the same
+#          host share the file's page cache instead of each holding a private copy.
+# parameters: lang, target language, as for load_pretrained
+#             path, checkpoint written by save_mapped
+# returns: fairseq GeneratorHubInterface
+#######################################################################################
+def load_mapped(lang, path=MAPPED_CHECKPOINT):
+    state = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    cfg = state["cfg"]
+    if OmegaConf.is_config(cfg.task):
+        with open_dict(cfg.task):
+            cfg.task.target_lang = lang
+    else:
+        cfg.task.target_lang = lang
+    task = tasks.setup_task(cfg.task)
+    with torch.device("meta"):
+        model = task.build_model(cfg.model)
+    # bypass fairseq's load_state_dict, which copies; the saved state is already upgraded
+    torch.nn.Module.load_state_dict(model, state["model"], strict=True, assign=True)
+    unmapped = [
+        name
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+        if tensor.is_meta
+    ]
+    if unmapped:
+        raise RuntimeError(
+            "{} has no weights for {}, re-run convert_checkpoints.py".format(
+                path, ", ".join(unmapped)
+            )
         )
+    # assign gives every state dict key its own Parameter, which unties the output
+    # projection from the embeddings; re-tie it as build_output_projection does
+    decoder = model.decoder
+    if decoder.share_input_output_embed:
+        decoder.output_projection.weight = decoder.embed_tokens.weight
+    check_tied(model, state["model"], path)
+    return GeneratorHubInterface(cfg, task, [model])
+
+
+def check_tied(model, state_dict, path):
+    """Raise unless state dict tensors sharing storage are loaded as a single Parameter.
+
+    An untied copy still shares the mmap on the CPU, but .to(cuda) would copy it once
+    per name, e.g. a second 250k x 1024 embedding for the output projection.
+    """
+    params = dict(model.named_parameters(remove_duplicate=False))
+    shared = {}
+    for name, tensor in state_dict.items():
+        if name in params and tensor.numel():
+            key = (tensor.data_ptr(), tuple(tensor.shape))
+            shared.setdefault(key, []).append(name)
+    untied = [
+        names for names in shared.values() if len({id(params[n]) for n in names}) > 1
+    ]
+    if untied:
+        raise RuntimeError(
+            "{} loaded tied weights as separate parameters: {}".format(
+                path, "; ".join(", ".join(names) for names in untied)
+            )
+        )
+
+
+class mbartAlt:
+    # lang is the pivot language, or a list of pivot languages to fan out over in
+    # get_prefix_alts (the first one is used everywhere else)
+    # max_rows is the most rows generate_rows decodes in one fairseq batch
+    def __init__(self, lang, max_rows=8):
+        self.langs = [lang] if isinstance(lang, str) else list(lang)
+        lang = self.langs[0]
+        if os.path.exists(MAPPED_CHECKPOINT):
+            self.bart = load_mapped(lang)
+        else:
+            logger.info(
+                "%s not found, loading the original checkpoint", MAPPED_CHECKPOINT
+            )
+            self.bart = load_pretrained(lang)
         self.bart.eval()
+        # fairseq's search calls decoder.forward directly, so module hooks never run;
+        # wrap forward itself so superseded or expired requests stop at the next step
+        decoder = self.bart.models[0].decoder
+        decoder_forward = decoder.forward
+
+        def checked_forward(*args, **kwargs):
+            cancellation.check()
+            return decoder_forward(*args, **kwargs)
+
+        decoder.forward = checked_forward
         self.bart.to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
         self.lang = lang
+        self.src_lang = self.bart.task.args.source_lang
+        self.max_rows = max_rows
+        # dictionary encoding of each constraint phrase, and packed tensors of whole
+        # constraint sets, as the same noun phrases recur across requests for a sentence
+        self.phrase_cache = LRUCache("constraint_phrases", 4096)
+        self.constraint_set_cache = LRUCache("constraint_sets", 512)
 
-    def constraint2tensor(self, constraints: [str]):
-        for i, constraint_list in enumerate(constraints):
-            constraints[i] = [
-                # encode with src_dict as this becomes tgt
-                self.bart.src_dict.encode_line(
-                    self.bart.apply_bpe(constraint),
-                    append_eos=False,
-                    add_if_not_exist=False,
-                )
-                for constraint in constraint_list
-            ]
-        return pack_constraints(constraints)
+    def encode_constraint(self, constraint: str):
+        tokens = self.phrase_cache.get(constraint)
+        if tokens is None:
+            # encode with src_dict as this becomes tgt
+            tokens = self.bart.src_dict.encode_line(
+                self.bart.apply_bpe(constraint),
+                append_eos=False,
+                add_if_not_exist=False,
+            )
+            self.phrase_cache.put(constraint, tokens)
+        return tokens
+
+    # constraints is a list with a list of constraint phrases for each row of the batch
+    def constraint2tensor(self, constraints: [[str]]):
+        key = tuple(tuple(constraint_list) for constraint_list in constraints)
+        packed = self.constraint_set_cache.get(key)
+        if packed is None:
+            packed = pack_constraints(
+                [
+                    [
+                        self.encode_constraint(constraint)
+                        for constraint in constraint_list
+                    ]
+                    for constraint_list in constraints
+                ]
+            )
+            self.constraint_set_cache.put(key, packed)
+        return packed
 
     def clean_lang_tok(self, input: str):
         return re.sub("^[\[].*[\]] ", "", input)
@@ -52,7 +185,7 @@ class mbartAlt:
         return hypos, word_alternatives
 
     def round_trip(self, sentence: str, constraints: [str]):
-        print(constraints)
+        logger.debug("round trip constraints: %s", constraints)
         constraints_tensor = self.constraint2tensor([constraints])
         # prefix = (
         #     self.bart.tgt_dict.encode_line(
@@ -69,20 +202,25 @@ class mbartAlt:
         orig_src = self.bart.task.args.source_lang
         self.bart.task.args.target_lang = orig_src
         self.bart.task.args.source_lang = orig_tgt
-
-        returned, word_alternatives = self.sample(
-            sentence,
-            beam=100,
-            verbose=True,
-            constraints="ordered",
-            inference_step_args={
-                "constraints": constraints_tensor,
-            },
-            no_repeat_ngram_size=4,
-            max_len_a=1,
-            max_len_b=2,
-            unkpen=10,
-        )
+        try:
+            returned, word_alternatives = self.sample(
+                sentence,
+                beam=100,
+                verbose=True,
+                constraints="ordered",
+                inference_step_args={
+                    "constraints": constraints_tensor,
+                },
+                no_repeat_ngram_size=4,
+                max_len_a=1,
+                max_len_b=2,
+                unkpen=10,
+            )
+        finally:
+            # restore original translation direction, also when cancelled mid-search
+            self.bart.task.args.target_lang = orig_tgt
+            self.bart.task.args.source_lang = orig_src
+        record_generation("mbart", 100, sum(len(hypo["tokens"]) for hypo in returned))
         resultset = []
         for i in range(len(returned)):
             resultset.append(
@@ -92,15 +230,152 @@ class mbartAlt:
                 )
             )
         # print(resultset)
-        # restore original translation direction
-        self.bart.task.args.target_lang = orig_tgt
-        self.bart.task.args.source_lang = orig_src
         return resultset, word_alternatives
 
-    def get_prefix_alts(self, sentence, prefixes: [str]):
-        away = self.bart.translate(sentence)
-        away = self.clean_lang_tok(away)
-        return [self.round_trip(away, [prefix]) for prefix in prefixes]
+    def translate_away(self, sentences: [str]):
+        """Translate english sentences into the pivot language in one batch."""
+        return [self.clean_lang_tok(away) for away in self.bart.translate(sentences)]
+
+    # summary: generate_rows runs batched generate calls where every row has its own
+    #          source and target language, unlike bart.generate which uses the task's
+    #          single language pair for the whole batch. Rows are decoded in chunks of
+    #          at most self.max_rows to bound memory use at large beam sizes.
+    # parameters: rows, list of (source language, target language, text to translate)
+    #             beam, beam size
+    #             constraints_tensor, optional packed constraints with one row per input row
+    #             kwargs, generation args as for bart.generate
+    # returns: list of fairseq hypotheses for each row, in the same order as rows
+    #######################################################################################
+    def generate_rows(self, rows, beam, constraints_tensor=None, **kwargs):
+        hypos = []
+        for start in range(0, len(rows), self.max_rows):
+            end = start + self.max_rows
+            hypos += self.generate_chunk(
+                rows[start:end],
+                beam,
+                None if constraints_tensor is None else constraints_tensor[start:end],
+                **kwargs,
+            )
+        record_generation(
+            "mbart",
+            beam,
+            sum(len(hypo["tokens"]) for row_hypos in hypos for hypo in row_hypos),
+        )
+        return hypos
+
+    def generate_chunk(self, rows, beam, constraints_tensor=None, **kwargs):
+        src_spec, tgt_spec = self.bart.task.args.langtoks["main"]
+        if tgt_spec is None:
+            raise RuntimeError("per-row target languages need decoder language tokens")
+        manager = self.bart.task.data_manager
+        device = self.bart._float_tensor.device
+
+        src_tokens = []
+        prefix_tokens = []
+        for src_lang, tgt_lang, text in rows:
+            for lang in (src_lang, tgt_lang):
+                if lang not in self.bart.task.langs:
+                    raise ValueError("unknown language: {}".format(lang))
+            tokens = self.bart.encode(text)
+            if src_spec:
+                langtok = manager.get_encoder_langtok(src_lang, tgt_lang, src_spec)
+                tokens = torch.cat([torch.LongTensor([langtok]), tokens])
+            src_tokens.append(tokens)
+            prefix_tokens.append([manager.get_decoder_langtok(tgt_lang, tgt_spec)])
+
+        lengths = [tokens.numel() for tokens in src_tokens]
+        dataset = LanguagePairDataset(
+            ListDataset(src_tokens, lengths), lengths, self.bart.src_dict
+        )
+        # the collater sorts rows by length, so reorder the per-row inputs to match
+        batch = dataset.collater([dataset[i] for i in range(len(rows))])
+        batch = utils.apply_to_sample(lambda t: t.to(device), batch)
+        order = batch["id"]
+        prefix_tokens = torch.LongTensor(prefix_tokens).to(device)[order]
+        if constraints_tensor is not None:
+            constraints_tensor = constraints_tensor.to(device)[order]
+
+        gen_args = copy.deepcopy(self.bart.cfg.generation)
+        with open_dict(gen_args):
+            gen_args.beam = beam
+            for k, v in kwargs.items():
+                setattr(gen_args, k, v)
+        generator = self.bart.task.build_generator(self.bart.models, gen_args)
+        translations = self.bart.task.inference_step(
+            generator,
+            self.bart.models,
+            batch,
+            prefix_tokens=prefix_tokens,
+            constraints=constraints_tensor,
+        )
+
+        hypos = [None] * len(rows)
+        for row, row_hypos in zip(order.tolist(), translations):
+            hypos[row] = row_hypos
+        return hypos
+
+    def translate_pivots(self, sentence: str, langs: [str]):
+        """Translate one english sentence into every pivot in langs in one batch."""
+        hypos = self.generate_rows(
+            [(self.src_lang, lang, sentence) for lang in langs], beam=5
+        )
+        return {
+            lang: self.clean_lang_tok(self.bart.decode(row_hypos[0]["tokens"]))
+            for lang, row_hypos in zip(langs, hypos)
+        }
+
+    # summary: get_prefix_alts round trips sentence through each pivot language, forcing each
+    #          prefix in the back translation. Forward translations are batched together, as
+    #          are the constrained back translations (in chunks of max_rows); the alternatives
+    #          for a prefix are merged across pivots and de-duplicated, keeping the best score.
+    # parameters: sentence, english sentence
+    #             prefixes, phrases to force at the start of the alternatives
+    #             away, optional precomputed translation: a string in self.lang (as from
+    #               translate_away) or a dict of pivot language -> translation
+    #             langs, pivot languages to use, defaults to the ones given to __init__
+    # returns: list with one list of (score, sentence) per prefix, best first
+    #######################################################################################
+    def get_prefix_alts(self, sentence, prefixes: [str], away=None, langs=None):
+        if not prefixes:
+            return []
+        langs = list(langs or self.langs)
+        if isinstance(away, str):
+            away = {self.lang: away}
+        away = dict(away or {})
+        missing = [lang for lang in langs if lang not in away]
+        if missing:
+            away.update(self.translate_pivots(sentence, missing))
+
+        rows = [
+            (lang, self.src_lang, away[lang]) for prefix in prefixes for lang in langs
+        ]
+        constraints_tensor = self.constraint2tensor(
+            [[prefix] for prefix in prefixes for lang in langs]
+        )
+        hypos = self.generate_rows(
+            rows,
+            beam=100,
+            constraints_tensor=constraints_tensor,
+            constraints="ordered",
+            no_repeat_ngram_size=4,
+            max_len_a=1,
+            max_len_b=2,
+            unkpen=10,
+        )
+
+        results = []
+        for i in range(len(prefixes)):
+            merged = {}
+            for row_hypos in hypos[i * len(langs) : (i + 1) * len(langs)]:
+                for hypo in row_hypos:
+                    text = self.clean_lang_tok(self.bart.decode(hypo["tokens"]))
+                    score = float(hypo["score"])
+                    if text not in merged or score > merged[text]:
+                        merged[text] = score
+            results.append(
+                sorted(((score, text) for text, score in merged.items()), reverse=True)
+            )
+        return results
 
     def word_alternatives(self, away_tokens, hypos_tokens):
         alternatives = []
@@ -180,4 +455,4 @@ if __name__ == "__main__":
             away,
             ["Heart attacks", "caused", "stress", "researchers"],
         )
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,117 @@
+import contextvars
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+logger = logging.getLogger("rearrange.trace")
+
+# id of the request currently being served, set by app.py for every request
+request_id = contextvars.ContextVar("request_id", default=None)
+
+REQUEST_LATENCY = Histogram(
+    "rearrange_request_seconds",
+    "Time spent serving an API request",
+    ["endpoint"],
+)
+STAGE_LATENCY = Histogram(
+    "rearrange_stage_seconds",
+    "Time spent in each stage of a model call",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+BEAM_SIZE = Histogram(
+    "rearrange_beam_size",
+    "Beam size used for each generate call",
+    ["model"],
+    buckets=(1, 3, 5, 10, 25, 50, 100, 200),
+)
+TOKENS_GENERATED = Counter(
+    "rearrange_tokens_generated_total",
+    "Tokens generated by the decoders (summed over returned hypotheses)",
+    ["model"],
+)
+CANCELLED = Counter(
+    "rearrange_cancelled_total",
+    "Requests stopped early, labelled by endpoint and reason (superseded/deadline)",
+    ["endpoint", "reason"],
+)
+ADMISSION_QUEUE = Gauge(
+    "rearrange_admission_queue_depth",
+    "Model calls waiting for admission, by priority class",
+    ["priority"],
+)
+ADMISSION_REJECTED = Counter(
+    "rearrange_admission_rejected_total",
+    "Model calls rejected because their priority class queue was full",
+    ["priority"],
+)
+CACHE_REQUESTS = Counter(
+    "rearrange_cache_requests_total",
+    "Cache lookups, labelled by cache and hit/miss",
+    ["cache", "result"],
+)
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+# summary: span times one stage of a request, records it in the stage histogram and
+#          emits a structured debug log line tagged with the current request id
+# parameters: stage, name of the stage (e.g. "generate_alternatives.round_trip")
+#             fields, extra key/values to include in the log line
+#######################################################################################
+@contextmanager
+def span(stage, **fields):
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(elapsed)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "span",
+                extra={
+                    "request_id": request_id.get(),
+                    "stage": stage,
+                    "duration_ms": round(elapsed * 1000, 2),
+                    **fields,
+                },
+            )
+
+
+def record_generation(model, beam, num_tokens):
+    BEAM_SIZE.labels(model).observe(beam)
+    TOKENS_GENERATED.labels(model).inc(num_tokens)
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def exposition():
+    """Current metrics in the Prometheus text format, with its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class SpanFormatter(logging.Formatter):
+    """Appends the structured span fields to the log message as key=value pairs."""
+
+    reserved = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        message = super().format(record)
+        extra = {k: v for k, v in vars(record).items() if k not in self.reserved}
+        if extra:
+            message += " " + " ".join("{}={}".format(k, v) for k, v in extra.items())
+        return message
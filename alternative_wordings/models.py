@@ -1,16 +1,43 @@
 import spacy
 import difflib
+import logging
+import threading
 from difflib import Differ, SequenceMatcher
 from mbart_model import mbartAlt
 from marian_model import marianAlt
+from metrics import span
+from admission import AdmissionController, Overloaded, PriorityClass
+from prefetch import CompletionPrefetcher
+import cancellation
 import torch
 
+logger = logging.getLogger(__name__)
+
 torch.cuda.empty_cache()
 nlp = spacy.load("en_core_web_sm")
 mbart = mbartAlt("nl_XX")
-print("here")
-# marian = marianAlt(">>es<<")
+logger.info("models loaded")
+# marian is only needed for completion (and generate_alternatives without mbart), so it
+# is loaded on first use through get_marian()
+marian = None
+marian_lock = threading.Lock()
 use_mbart = True
+# default cap on how many prefixes generate_alternatives decodes (None for no cap)
+prefix_limit = None
+# how many likely next words speculative completion prefetches
+prefetch_words = 3
+
+# model calls go through admission control: completion is interactive, while
+# generate_alternatives, generate_constraints and batches are heavy and wait behind it,
+# and speculative prefetching only runs when nothing else is waiting
+admission = AdmissionController(
+    slots=1,
+    classes=[
+        PriorityClass("interactive", concurrency=1, max_queue=16),
+        PriorityClass("heavy", concurrency=1, max_queue=4),
+        PriorityClass("background", concurrency=1, max_queue=2),
+    ],
+)
 
 # Dictionary to convert pronouns for passive to active voice
 obj_to_subj_pronouns = {
@@ -24,6 +51,7 @@ obj_to_subj_pronouns = {
 
 off_limits = []
 
+
 # get prepositional phrases
 # adapted from https://stackoverflow.com/questions/39100652/python-chunking-others-than-noun-phrases-e-g-prepositional-using-spacy-etc
 def get_pps(doc):
@@ -53,6 +81,15 @@ def get_adv_clause(doc):
     return clauses
 
 
+def get_marian():
+    global marian
+    with marian_lock:
+        if marian is None:
+            marian = marianAlt(">>es<<")
+            logger.info("marian loaded")
+    return marian
+
+
 def capitalize_first_word(phrase):
     return phrase.split(" ")[0].capitalize() + " " + " ".join(phrase.split(" ")[1:])
 
@@ -148,15 +185,12 @@ def calculate_differences(alternatives, original_sentence, prefix):
     for option in alternatives:
         diffs = []
         a = original_sentence.split()
-        print(a)
         b = option.split()
-        print(b)
         s = SequenceMatcher(None, a, b)
         for tag, i1, i2, j1, j2 in s.get_opcodes():
             if tag != "equal":
                 x = j1 - len(prefix.split()) + 1
                 for string in b[j1:j2]:
-                    print(string)
                     diffs.append(x)
                     x += 1
         differences.append(diffs)
@@ -219,8 +253,49 @@ def get_phrases(doc):
     return phrases
 
 
+# summary: canonicalize_prefixes normalizes the candidate prefixes from get_phrases, merges
+#          ones that only differ in case or whitespace and ranks the rest so that a cap
+#          keeps the most useful ones
+# parameters: phrases, candidate prefixes
+#             sentence, the original sentence
+#             limit, optional maximum number of prefixes to keep
+# returns: list of prefixes to decode, best first
+#          number of phrases merged into another one
+#          number of distinct prefixes dropped by limit
+#######################################################################################
+def canonicalize_prefixes(phrases, sentence, limit=None):
+    groups = {}
+    for phrase in phrases:
+        text = " ".join(phrase.split())
+        key = text.casefold()
+        if key in groups:
+            groups[key]["count"] += 1
+        else:
+            groups[key] = {"text": text, "count": 1, "order": len(groups)}
+
+    # phrases proposed by several extractors first, then by position in the sentence
+    lowered = sentence.casefold()
+
+    def rank(group):
+        position = lowered.find(group["text"].casefold())
+        return (
+            -group["count"],
+            position if position >= 0 else len(lowered),
+            group["order"],
+        )
+
+    ranked = [group["text"] for group in sorted(groups.values(), key=rank)]
+    merged = len(phrases) - len(ranked)
+    skipped = 0
+    if limit is not None and len(ranked) > limit:
+        skipped = len(ranked) - limit
+        ranked = ranked[:limit]
+    return ranked, merged, skipped
+
+
 def incremental_alternatives(sentence, prefix, recalculation):
-    doc = nlp(sentence)
+    with span("incremental_alternatives.parse"):
+        doc = nlp(sentence)
     highlight = []
     for chunk in doc.noun_chunks:
         highlight.append(chunk.text)
@@ -235,32 +310,84 @@ def incremental_alternatives(sentence, prefix, recalculation):
     # return marian.incremental_alternatives(sentence, prefix, recalculation)
 
 
+def validate_pivots(pivots):
+    """Raise ValueError unless pivots is None or a non-empty list of mbart languages."""
+    if pivots is None:
+        return
+    if (
+        not isinstance(pivots, list)
+        or not pivots
+        or not all(isinstance(lang, str) for lang in pivots)
+    ):
+        raise ValueError("pivots must be a non-empty list of language codes")
+    unknown = [lang for lang in pivots if lang not in mbart.bart.task.langs]
+    if unknown:
+        raise ValueError("unknown pivot languages: {}".format(", ".join(unknown)))
+
+
+def validate_max_prefixes(max_prefixes):
+    """Raise ValueError unless max_prefixes is None or a positive int."""
+    if max_prefixes is None:
+        return
+    if (
+        not isinstance(max_prefixes, int)
+        or isinstance(max_prefixes, bool)
+        or max_prefixes < 1
+    ):
+        raise ValueError("maxPrefixes must be a positive integer")
+
+
 # summary: generate_alternatives generates alternative sentences for a given english sentence.
 # parameters: english, the original sentence to get alternatives of
+#             away, optional precomputed mbart.translate_away() output for english
+#             pivots, optional list of mbart pivot languages to fan out over
+#             max_prefixes, optional cap on the number of prefixes decoded (default prefix_limit)
 # returns: dict including:
 #             alternatives, a list of lists of sentences with each outer list having a
 #               different forced starting prefix and inner lists having different endings
 #             color_coding, a list for each alternative sentence separating the sentence
 #               into its sentence parts
+#             meta, counts of prefixes decoded, merged as duplicates and skipped by the cap
 #######################################################################################
-def generate_alternatives(english):
+def generate_alternatives(english, away=None, pivots=None, max_prefixes=None):
+    validate_pivots(pivots)
+    validate_max_prefixes(max_prefixes)
     sentence = english
-    doc = nlp(sentence)
-    phrases = get_phrases(doc)
+    with span("generate_alternatives.parse"):
+        doc = nlp(sentence)
+    with span("generate_alternatives.get_phrases") as fields:
+        phrases = get_phrases(doc)
+        fields["phrases"] = len(phrases)
+    if max_prefixes is None:
+        max_prefixes = prefix_limit
+    with span("generate_alternatives.canonicalize") as fields:
+        phrases, merged, skipped = canonicalize_prefixes(
+            phrases, sentence, max_prefixes
+        )
+        fields.update(prefixes=len(phrases), merged=merged, skipped=skipped)
 
+    meta = {"prefixes": len(phrases), "merged": merged, "skipped": skipped}
     results = []
 
-    if use_mbart:
-        results = mbart.get_prefix_alts(sentence, phrases)
-    else:
-        results = marian.get_prefix_alts(sentence, phrases)
+    if phrases:
+        with admission.admit("heavy"), span("generate_alternatives.get_prefix_alts"):
+            if use_mbart:
+                results = mbart.get_prefix_alts(sentence, phrases, away, pivots)
+            else:
+                results = get_marian().get_prefix_alts(sentence, phrases)
+
+    # nothing was decoded, so there is no top sentence to color code
+    if not any(results):
+        return {"alternatives": [], "colorCoding": [], "meta": meta}
 
-    score = get_score(doc, sentence, results)
+    with span("generate_alternatives.score"):
+        score = get_score(doc, sentence, results)
 
     # sort results with highest score first
     all_sorted = sorted(results, key=lambda x: x[0])[::-1]
 
-    color_code_chunks = get_color_chunks(all_sorted, doc, score)
+    with span("generate_alternatives.color_chunks"):
+        color_code_chunks = get_color_chunks(all_sorted, doc, score)
 
     alternatives = []
     scores = []
@@ -270,35 +397,88 @@ def generate_alternatives(english):
             altgroup.append(result)
         alternatives.append(altgroup)
 
-    print(alternatives)
+    logger.debug("alternatives: %s", alternatives)
 
-    return {"alternatives": alternatives, "colorCoding": color_code_chunks}
+    return {
+        "alternatives": alternatives,
+        "colorCoding": color_code_chunks,
+        "meta": meta,
+    }
 
 
 # summary: completion
 # parameters: sentence, the sentence to generate alternatives of
 #             prefix, A prefix to force in generating new sentence
+#             machine_translation, optional precomputed marian.pivot_translations() output for sentence
+#             session, optional client session id; completions prefetched for it are used first
+#             speculate, if true (and session is given) prefetch completions for the most
+#               likely next words after prefix in the background
+#             priority, admission class the model call runs in
 # returns: dict including:
 #               endings, list possible alternative sentence endings
 #               differences, a list for each alternative sentence specifying the differences
 #                   between it and the original
 #######################################################################################
-def completion(sentence, prefix):
+def completion(
+    sentence,
+    prefix,
+    machine_translation=None,
+    session=None,
+    speculate=False,
+    priority="interactive",
+):
     prefix = prefix.replace(" ", "", 1)
-    top5 = marian.completion(sentence, prefix)
+    prefetched = None
+    if session is not None:
+        # a real request from this session goes ahead of its own prefetching
+        prefetcher.cancel(session)
+        prefetched = prefetcher.lookup(session, sentence, prefix)
+    if prefetched is None:
+        result, machine_translation = complete(
+            sentence, prefix, machine_translation, priority
+        )
+    else:
+        result, machine_translation = prefetched
+    if speculate and session is not None:
+        # reuse the translation so the prefetch does not translate the sentence again
+        prefetcher.schedule(session, sentence, prefix, machine_translation)
+    return result
+
+
+# completion without the prefetch cache, for an already normalized prefix; also returns
+# the machine translation used so callers can reuse it
+def complete(sentence, prefix, machine_translation=None, priority="interactive"):
+    with admission.admit(priority), span("completion.translate"):
+        if machine_translation is None:
+            machine_translation = get_marian().pivot_translations([sentence])[0]
+        top5 = get_marian().completion(sentence, prefix, machine_translation)
     # caculate difference in words for each alternative
-    differences = calculate_differences(top5, sentence, prefix)
-    print("prefix length: ", len(prefix.split()))
+    with span("completion.differences"):
+        differences = calculate_differences(top5, sentence, prefix)
+    logger.debug("prefix length: %d", len(prefix.split()))
 
     endings = []
     for s in top5:
         endings.append(s.replace(prefix, ""))
 
-    return {"endings": endings, "differences": differences}
+    return {"endings": endings, "differences": differences}, machine_translation
 
 
-def generate_constraints(sentence, constraints):
-    print(sentence)
+def predict_next_prefixes(sentence, prefix, machine_translation):
+    with admission.admit("background"), span("completion.predict_next"):
+        return get_marian().next_words(machine_translation, prefix, prefetch_words)
+
+
+prefetcher = CompletionPrefetcher(
+    predict_next_prefixes,
+    lambda sentence, prefix, machine_translation: complete(
+        sentence, prefix, machine_translation, priority="background"
+    )[0],
+)
+
+
+def generate_constraints(sentence, constraints, away=None):
+    logger.debug("constraints for: %s", sentence)
     new_constraints = []
     for idx, constraint in enumerate(constraints):
         # too simple filtering of "the"
@@ -319,12 +499,113 @@ def generate_constraints(sentence, constraints):
     #             usable_prefix = prefix
     #     print(usable_prefix)
     # print(usable_prefix)
-    away = mbart.bart.translate(sentence)
-    away = mbart.clean_lang_tok(away)
-    resultset, word_alternatives = mbart.round_trip(away, new_constraints)
+    with admission.admit("heavy"):
+        if away is None:
+            with span("generate_constraints.translate"):
+                away = mbart.translate_away([sentence])[0]
+        with span("generate_constraints.round_trip", constraints=len(new_constraints)):
+            resultset, word_alternatives = mbart.round_trip(away, new_constraints)
     return {"result": resultset[0][1], "word_alternatives": word_alternatives}
 
 
+# most operations a single run_batch call accepts
+max_batch_operations = 32
+
+# operations accepted by run_batch, with the fields each one reads from its item
+batch_operations = {
+    "result": ["english"],
+    "completion": ["sentence", "prefix"],
+    "constraints": ["sentence", "constraints"],
+}
+
+
+def batch_error(err):
+    return {"error": "{}: {}".format(type(err).__name__, err)}
+
+
+# summary: run_batch runs many result/completion/constraints operations in one call.
+#          The forward (english -> pivot) translations are done up front in one batched
+#          pass per model and shared by every operation on the same sentence. The rest of
+#          each operation, including the back translations, still runs per item.
+#          Every model call runs at heavy priority. Cancellation or a full admission
+#          queue aborts the whole batch; any other failure becomes that item's error.
+# parameters: operations, list of dicts each with an "op" key naming one of batch_operations
+#               plus the same fields as the matching GET endpoint
+# returns: list in the same order as operations; each item is {"result": ...} or {"error": ...}
+#######################################################################################
+def run_batch(operations):
+    if len(operations) > max_batch_operations:
+        raise ValueError("at most {} operations per batch".format(max_batch_operations))
+    results = [None] * len(operations)
+    valid = []
+    for idx, item in enumerate(operations):
+        try:
+            fields = batch_operations[item["op"]]
+            valid.append((idx, item, [item[field] for field in fields]))
+        except (KeyError, TypeError) as err:
+            results[idx] = batch_error(err)
+
+    # one batched forward translation per model, keyed by sentence
+    mbart_sentences = list(
+        dict.fromkeys(args[0] for _, item, args in valid if item["op"] != "completion")
+    )
+    marian_sentences = list(
+        dict.fromkeys(args[0] for _, item, args in valid if item["op"] == "completion")
+    )
+    translations = {}
+    for model_name, sentences in [
+        ("mbart", mbart_sentences),
+        ("marian", marian_sentences),
+    ]:
+        if not sentences:
+            continue
+        try:
+            with admission.admit("heavy"), span(
+                "run_batch.translate", model=model_name, sentences=len(sentences)
+            ):
+                if model_name == "mbart":
+                    translated = mbart.translate_away(sentences)
+                else:
+                    translated = get_marian().pivot_translations(sentences)
+            translations[model_name] = dict(zip(sentences, translated))
+        except (cancellation.Cancelled, Overloaded):
+            raise
+        except Exception as err:
+            logger.exception("batched %s translation failed", model_name)
+            translations[model_name] = err
+
+    for idx, item, args in valid:
+        op = item["op"]
+        model_name = "marian" if op == "completion" else "mbart"
+        pivot = translations[model_name]
+        if isinstance(pivot, Exception):
+            results[idx] = batch_error(pivot)
+            continue
+        try:
+            if op == "result":
+                result = generate_alternatives(
+                    *args,
+                    away=pivot[args[0]],
+                    pivots=item.get("pivots"),
+                    max_prefixes=item.get("maxPrefixes"),
+                )
+            elif op == "completion":
+                # batches are heavy work, so their completions queue behind
+                # interactive ones
+                result = completion(
+                    *args, machine_translation=pivot[args[0]], priority="heavy"
+                )
+            else:
+                result = generate_constraints(*args, away=pivot[args[0]])
+            results[idx] = {"result": result}
+        except (cancellation.Cancelled, Overloaded):
+            raise
+        except Exception as err:
+            logger.exception("batch item %d (%s) failed", idx, op)
+            results[idx] = batch_error(err)
+    return results
+
+
 if __name__ == "__main__":
     # test for function output
     # genAltReturn = generate_alternatives(
@@ -0,0 +1,89 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cancellation
+from admission import Overloaded
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+# summary: CompletionPrefetcher speculatively computes completions for the words a user is
+#          likely to pick next and keeps them in a small cache per session. Jobs run one at
+#          a time on a background thread. Scheduling a job for a session makes its older
+#          jobs stale: queued ones are skipped and a running one stops before its next
+#          completion. A real request from the session cancels its running job at once.
+# parameters: predict, function (sentence, prefix, machine translation) -> list of likely
+#               next prefixes
+#             compute, function (sentence, prefix, machine translation) -> completion result
+#             max_sessions, number of sessions to keep caches for
+#             per_session, number of completions cached per session
+#######################################################################################
+class CompletionPrefetcher:
+    def __init__(self, predict, compute, max_sessions=256, per_session=32):
+        self.predict = predict
+        self.compute = compute
+        self.max_sessions = max_sessions
+        self.per_session = per_session
+        self.sessions = OrderedDict()
+        # session -> number of the newest job scheduled for it
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+    def session_cache(self, session):
+        with self.lock:
+            cache = self.sessions.get(session)
+            if cache is None:
+                cache = LRUCache("completion_prefetch", self.per_session)
+                self.sessions[session] = cache
+                while len(self.sessions) > self.max_sessions:
+                    evicted, _ = self.sessions.popitem(last=False)
+                    self.generations.pop(evicted, None)
+            self.sessions.move_to_end(session)
+            return cache
+
+    def lookup(self, session, sentence, prefix):
+        """Prefetched (completion, machine translation) for prefix, or None."""
+        return self.session_cache(session).get((sentence, prefix))
+
+    def schedule(self, session, sentence, prefix, machine_translation):
+        """Start prefetching completions for the likely words after prefix."""
+        with self.lock:
+            generation = self.generations.get(session, 0) + 1
+            self.generations[session] = generation
+        self.executor.submit(
+            self.run, session, generation, sentence, prefix, machine_translation
+        )
+
+    def cancel(self, session):
+        """Stop the running prefetch for session, e.g. when it sends a real request."""
+        cancellation.cancel(session, "prefetch")
+
+    def stale(self, session, generation):
+        """True once a newer job was scheduled for session (or the session was evicted)."""
+        with self.lock:
+            return self.generations.get(session) != generation
+
+    def run(self, session, generation, sentence, prefix, machine_translation):
+        if self.stale(session, generation):
+            logger.debug("prefetch for %r skipped: superseded", prefix)
+            return
+        cache = self.session_cache(session)
+        with cancellation.scope(session, kind="prefetch"):
+            try:
+                candidates = self.predict(sentence, prefix, machine_translation)
+                for candidate in candidates:
+                    if self.stale(session, generation):
+                        logger.debug("prefetch for %r stopped: superseded", prefix)
+                        return
+                    if (sentence, candidate) in cache:
+                        continue
+                    result = self.compute(sentence, candidate, machine_translation)
+                    cache.put((sentence, candidate), (result, machine_translation))
+            except (cancellation.Cancelled, Overloaded) as err:
+                logger.debug("prefetch for %r stopped: %s", prefix, err)
+            except Exception:
+                logger.exception("prefetch for %r failed", prefix)